@@ -14,8 +14,12 @@
 # 2024-12-01 Added ability to let users specifiy a init command
 
 
+import functools
 import logging
 import os
+import platform
+import shlex
+import signal
 from pathlib import Path
 
 import gi
@@ -32,8 +36,7 @@ from zim.gui.pageview import PageViewExtension
 from zim.gui.preferencesdialog import PluginConfigureDialog
 
 from zim.gui.widgets import BOTTOM_PANE, PANE_POSITIONS, \
-    IconButton, ScrolledWindow, \
-    WindowSidePaneWidget
+    IconButton, WindowSidePaneWidget
 
 logger = logging.getLogger('zim.plugins.terminal')
 
@@ -42,12 +45,53 @@ FONT_SIZE_MAX = 72
 DEFAULT_FONT_SIZE = 9
 DEFAULT_FONT_COLOR = "#FFFFFF"
 DEFAULT_BACKGROUND_COLOR = "#000000"
-DEFAULT_COMMAND_INTERPRETER = "/bin/bash"
 DEFAULT_INIT_COMMAND = ""
-CLEAR_COMMAND = "clear"
+
+# Per-OS defaults, resolved with a single platform.system() call at import
+_DEFAULTS_BY_OS = {
+    'Darwin': ('/bin/bash', 'clear'),
+    'Linux': ('/bin/bash', 'clear'),
+    'Windows': ('cmd.exe', 'cls'),
+}
+DEFAULT_COMMAND_INTERPRETER, CLEAR_COMMAND = \
+    _DEFAULTS_BY_OS.get(platform.system(), ('/bin/sh', 'clear'))
 
 DEFAULT_AUTO_SWITCH_PATH_ON_PAGE_CHANGE = True
 
+_CTRL_SHIFT = int(Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.SHIFT_MASK)
+
+# Keyval -> widget method for the ctrl+shift shortcuts, upper and lower case
+_KEY_ACTIONS = {
+    Gdk.KEY_c: 'copy_clipboard',
+    Gdk.KEY_C: 'copy_clipboard',
+    Gdk.KEY_v: 'paste_clipboard',
+    Gdk.KEY_V: 'paste_clipboard',
+}
+
+_VTE_HAS_BINARY = (Vte.MAJOR_VERSION, Vte.MINOR_VERSION) >= (0, 42) \
+    and hasattr(Vte.Terminal, 'feed_child_binary')
+
+_CLEAR_BYTES = (CLEAR_COMMAND + "\n").encode("utf-8")
+
+
+@functools.lru_cache(maxsize=64)
+def _encode_command(resolved_cmdline):
+    """ Encodes a command line to UTF-8, cached so repeated commands like
+    'cd <path>' are not re-encoded on every page change.
+    """
+    return resolved_cmdline.encode("utf-8")
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_rgba(color_string):
+    """ Parses C{color_string} into a C{Gdk.RGBA}. Cached because the same
+    color strings are parsed again on every preference change. Callers must
+    not mutate the returned instance.
+    """
+    rgba = Gdk.RGBA()
+    rgba.parse(color_string)
+    return rgba
+
 
 class TerminalPlugin(PluginClass):
     plugin_info = {
@@ -77,6 +121,7 @@ class TerminalWindowExtension(PageViewExtension):
         self.window = window
         self.preferences = plugin.preferences
         self._monitor = None
+        self._last_page_name = None
 
         # Init terminal widget
         self.widget = TerminalPluginWidget(plugin, window, self.uistate)
@@ -88,6 +133,9 @@ class TerminalWindowExtension(PageViewExtension):
         self.add_sidepane_widget(self.widget, 'pane')
 
     def on_page_changed(self, pageview, page):
+        if page.name == self._last_page_name:
+            return  # Same page, attachments dir cannot have moved
+        self._last_page_name = page.name
         self.widget.set_folder(
             pageview.notebook.get_attachments_dir(page)
         )
@@ -100,21 +148,22 @@ class ZimTerminal(Vte.Terminal):
     """
 
     def execute_command(self, command):
+        if command == CLEAR_COMMAND and _VTE_HAS_BINARY:
+            self.feed_child_binary(_CLEAR_BYTES)
+            return
         if command[-1] != "\n":
             command += "\n"
         self.feed_child(command)
 
-    def feed_child(self, resolved_cmdline):
-        if (Vte.MAJOR_VERSION, Vte.MINOR_VERSION) >= (0, 42):
-            encoded = resolved_cmdline.encode("utf-8")
-            try:
-                super().feed_child_binary(encoded)
-            except TypeError:
-                # The doc doest not say clearly at which version the feed_child* function has lost
-                # the "len" parameter :(
-                super().feed_child(resolved_cmdline, len(resolved_cmdline))
-        else:
-            super().feed_child(resolved_cmdline, len(resolved_cmdline))
+    def _feed_child_binary(self, resolved_cmdline):
+        super().feed_child_binary(_encode_command(resolved_cmdline))
+
+    def _feed_child_legacy(self, resolved_cmdline):
+        super().feed_child(resolved_cmdline, len(resolved_cmdline))
+
+    # Specialize at import time instead of checking the Vte version on
+    # every call
+    feed_child = _feed_child_binary if _VTE_HAS_BINARY else _feed_child_legacy
 
 
 class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
@@ -129,18 +178,33 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
         self.window = window
         self.uistate = uistate
         self._close_button = None
+        self._path_cache = {}
+        self._child_pid = None
+        self._spawn_generation = 0
+        self._last_fg = self._last_bg = self._last_size = None
 
-        self.context_menu = self.create_context_menu()
+        self.context_menu = None
 
         self.terminalview = ZimTerminal()
-        self.terminalview.connect("button-press-event", self.on_button_press)
-        self.terminalview.connect("key-press-event", self.on_key_press_event)
+        self._font_desc = self.terminalview.get_font().copy()
+        self._button_press_handler = \
+            self.terminalview.connect("button-press-event", self.on_button_press)
+        self._key_press_handler = \
+            self.terminalview.connect("key-press-event", self.on_key_press_event)
         self.init_terminal()
 
-        self.add(ScrolledWindow(self.terminalview, shadow=Gtk.ShadowType.NONE))
+        # Vte renders its own scrollback, no ScrolledWindow/viewport needed;
+        # a plain scrollbar on Vte's adjustment is enough
+        self.pack_start(self.terminalview, True, True, 0)
+        scrollbar = Gtk.Scrollbar(
+            orientation=Gtk.Orientation.VERTICAL,
+            adjustment=self.terminalview.get_vadjustment(),
+        )
+        self.pack_start(scrollbar, False, False, 0)
 
         self.on_preferences_changed()
-        self.preferences.connect('changed', self.on_preferences_changed)
+        self._prefs_handler = self.preferences.connect('changed', self.on_preferences_changed)
+        self.connect('destroy', self.on_destroy)
 
         self.buttonbox = Gtk.VBox()
         self.pack_end(self.buttonbox, False, True, 0)
@@ -153,6 +217,12 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
         change_path_button.connect('clicked', lambda o: self.on_change_path_button())
         self.buttonbox.pack_start(change_path_button, False, True, 0)
 
+    def _get_context_menu(self):
+        """Return the context menu, building it on first use."""
+        if self.context_menu is None:
+            self.context_menu = self.create_context_menu()
+        return self.context_menu
+
     def create_context_menu(self):
         """Create the context menu for the terminal."""
         context_menu = Gtk.Menu()
@@ -190,11 +260,31 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
         return context_menu
 
     def on_preferences_changed(self, *a):
-        self.terminalview.set_color_foreground(self.font_color)
-        self.terminalview.set_color_background(self.background_color)
-        font = self.terminalview.get_font()
-        font.set_size(self.font_size * Pango.SCALE)
-        self.terminalview.set_font(font)
+        # Compare the raw preference values first; the 'changed' signal also
+        # fires for preferences that do not affect styling at all
+        fg = self.preferences['font_color']
+        bg = self.preferences['background_color']
+        size = self.preferences['font_size']
+        fg_changed = fg != self._last_fg
+        bg_changed = bg != self._last_bg
+        size_changed = size != self._last_size
+        if not (fg_changed or bg_changed or size_changed):
+            return  # Nothing to restyle
+
+        # Coalesce the setters into a single notify cycle
+        self.terminalview.freeze_notify()
+        try:
+            if fg_changed:
+                self.terminalview.set_color_foreground(_parse_rgba(fg))
+            if bg_changed:
+                self.terminalview.set_color_background(_parse_rgba(bg))
+            if size_changed:
+                self._font_desc.set_size(size * Pango.SCALE)
+                self.terminalview.set_font(self._font_desc)
+        finally:
+            self.terminalview.thaw_notify()
+
+        self._last_fg, self._last_bg, self._last_size = fg, bg, size
 
     def on_properties_button(self):
         self.show_properties()
@@ -203,61 +293,161 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
         self.reset_terminal()
         self.terminalview.grab_focus()
 
+    def on_destroy(self, *a):
+        """ Disconnects signal handlers so they do not accumulate on the
+        shared preferences object when windows are closed and reopened. """
+        self.preferences.disconnect(self._prefs_handler)
+        self.terminalview.disconnect(self._button_press_handler)
+        self.terminalview.disconnect(self._key_press_handler)
+
     def on_button_press(self, terminal, event):
         """Handle right click for context menu."""
         if event.button == 3:
-            self.context_menu.popup(None, None, None, None, event.button, event.time)
+            self._get_context_menu().popup(None, None, None, None, event.button, event.time)
             return True
 
     def on_key_press_event(self, widget, event):
         """ Implements copy (ctrl+shift+c) and paste (ctrl+shift+v) for the terminal. """
         if event.type == Gdk.EventType.KEY_PRESS:
-            control_key = Gdk.ModifierType.CONTROL_MASK & event.state
-            shift_key = Gdk.ModifierType.SHIFT_MASK & event.state
-            if control_key and shift_key:  # control and shift
-                if event.keyval == 67:  # C key
-                    self.copy_clipboard()
-                elif event.keyval == 86:  # V key
-                    self.paste_clipboard()
+            if (event.state & _CTRL_SHIFT) == _CTRL_SHIFT:  # control and shift
+                action = _KEY_ACTIONS.get(event.keyval)
+                if action:
+                    getattr(self, action)()
                 return True
 
     def copy_clipboard(self):
         """ Copies the selected text to the clipboard. """
         self.terminalview.copy_clipboard()
-        self.terminalview.grab_focus()
+        self._focus_terminal()
 
     def paste_clipboard(self):
         """ Pastes the selected text into the terminal. """
         self.terminalview.paste_clipboard()
-        self.terminalview.grab_focus()
+        self._focus_terminal()
 
-    def init_terminal(self):
-        """ Initializes the terminal """
-        self.terminalview.spawn_sync(
-            Vte.PtyFlags.DEFAULT,
-            self.path,
-            [self.command_interpreter],
-            [],
-            GLib.SpawnFlags.DO_NOT_REAP_CHILD,
-            None,
-            None,
-        )
+    def _focus_terminal(self):
+        # Only needed when triggered from the context menu; in the keyboard
+        # shortcut path the terminal already has focus
+        if not self.terminalview.has_focus():
+            self.terminalview.grab_focus()
 
-        # Execute init command
-        self.terminalview.execute_command(self.init_command)
+    def init_terminal(self, spawned_callback=None):
+        """ Initializes the terminal """
+        def on_spawned(*a):
+            # Change to the attachment folder from within the shell instead of
+            # passing it as working directory to the spawn call
+            self.terminalview.execute_command('cd %s' % shlex.quote(self.path))
+            # Execute init command
+            self.terminalview.execute_command(self.init_command)
+            if spawned_callback:
+                spawned_callback()
+
+        self.spawn_terminal(on_spawned)
+
+    def spawn_terminal(self, spawned_callback):
+        """ Spawns the command interpreter in the terminal and calls
+        C{spawned_callback} once the child is running. Uses the non-blocking
+        C{spawn_async} when available (Vte >= 0.48) so the GTK main loop is
+        not stalled during fork/exec; falls back to C{spawn_sync} on older Vte.
+
+        No working directory, child setup function or extra spawn flags are
+        passed, so GLib can use its fast C{posix_spawn()} path instead of
+        fork()ing a copy of the whole interpreter address space.
+        """
+        self._terminate_child()
+        self._spawn_generation += 1
+        generation = self._spawn_generation
+        if (Vte.MAJOR_VERSION, Vte.MINOR_VERSION) >= (0, 48):
+            def on_spawned(terminal, pid, error, user_data):
+                if error is not None or pid <= 0:
+                    # Spawn failed (e.g. bad interpreter preference), there is
+                    # no child to track and no PTY worth feeding
+                    logger.warning('Failed to spawn terminal child: %s', error)
+                    return
+                if generation != self._spawn_generation:
+                    # A newer spawn superseded this one while it was pending;
+                    # _terminate_child could not see its pid yet, so reap here
+                    self._kill_child(pid)
+                    return
+                self._child_pid = pid
+                spawned_callback()
+
+            self.terminalview.spawn_async(
+                Vte.PtyFlags.DEFAULT,
+                None,
+                [self.command_interpreter],
+                [],
+                GLib.SpawnFlags.DEFAULT,
+                None,
+                None,
+                -1,
+                None,
+                on_spawned,
+                None,
+            )
+        else:
+            _success, pid = self.terminalview.spawn_sync(
+                Vte.PtyFlags.DEFAULT,
+                None,
+                [self.command_interpreter],
+                [],
+                GLib.SpawnFlags.DEFAULT,
+                None,
+                None,
+            )
+            if not _success or pid <= 0:
+                logger.warning('Failed to spawn terminal child')
+                return
+            self._child_pid = pid
+            spawned_callback()
+
+    def _terminate_child(self):
+        """ Terminates the current shell process, if any, so respawning does
+        not accumulate orphaned shells over a long session.
+        """
+        if self._child_pid is not None:
+            self._kill_child(self._child_pid)
+            self._child_pid = None
+
+    @staticmethod
+    def _kill_child(pid):
+        if pid <= 0:
+            # Never signal pid <= 0; kill(-1) targets every process the
+            # user can signal
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
 
     def reset_terminal(self):
         """ Resets the terminal to the current path. """
-        self.init_terminal()
         # Clear screen after terminal init/refresh
-        self.terminalview.execute_command(CLEAR_COMMAND)
+        self.init_terminal(
+            spawned_callback=lambda: self.terminalview.execute_command(CLEAR_COMMAND)
+        )
 
     def show_properties(self):
         """ Shows the properties dialog and refreshes the path. """
-        if PluginConfigureDialog(self.window, self.plugin).run() == Gtk.ResponseType.OK:
-            self.reset_terminal()
+        def on_response(dialog, response):
+            if response == Gtk.ResponseType.OK:
+                self.reset_terminal()
+
+        # Connect to 'response' instead of blocking in run(), so the main
+        # loop keeps pumping PTY output while the dialog is open. Use
+        # connect_after so the zim dialog class closure has saved the
+        # preferences before the terminal is reset with them.
+        dialog = PluginConfigureDialog(self.window, self.plugin)
+        dialog.connect_after('response', on_response)
+        dialog.show_all()
 
     def set_folder(self, folder):
+        folder_path = folder._inner_fs_object.path
+        if folder_path == getattr(self, '_last_folder_path', None):
+            # Same attachments folder as before, no need to respawn the shell
+            return
+        self._last_folder_path = folder_path
+        self._path_cache.clear()
         self.folder = folder
         if self.preferences['auto_switch_path_on_page_change']:
             self.reset_terminal()
@@ -268,15 +458,11 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
 
     @property
     def font_color(self):
-        rgba = Gdk.RGBA()
-        rgba.parse(self.preferences['font_color'])
-        return rgba
+        return _parse_rgba(self.preferences['font_color'])
 
     @property
     def background_color(self):
-        rgba = Gdk.RGBA()
-        rgba.parse(self.preferences['background_color'])
-        return rgba
+        return _parse_rgba(self.preferences['background_color'])
 
     @property
     def command_interpreter(self):
@@ -292,6 +478,9 @@ class TerminalPluginWidget(Gtk.HBox, WindowSidePaneWidget):
         instead. """
         try:
             _path = self.folder._inner_fs_object.path
-            return _path if os.path.isdir(_path) else str(Path(_path).parent)
+            if _path not in self._path_cache:
+                # os.path.isdir() is a stat() syscall, cache the result per folder
+                self._path_cache[_path] = _path if os.path.isdir(_path) else str(Path(_path).parent)
+            return self._path_cache[_path]
         except:
             return os.environ['HOME']